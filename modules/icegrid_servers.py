@@ -11,12 +11,16 @@ DOCUMENTATION = '''
 module: icegrid_servers
 short_description: Control servers running on an IceGrid Registry
 description:
-    - Start, stop, enable, and disable servers controlled by an IceGrid Registry. Ice for Python is required.
+    - Start, stop, enable, and disable servers controlled by an IceGrid Registry. Ice for Python 3.7 or later is required.
+    - The servers are updated concurrently. If the task fails for one server, the other servers may still have been
+      changed. These are reported in the result of the failed task.
 options:
     host:
         required: false
         description:
-            - IceGrid registry host. Defaults to localhost.
+            - IceGrid registry host. Defaults to localhost. Running the task on the registry host itself with
+              delegate_to avoids the WAN latency of the requests sent to the registry, provided the endpoints
+              published by the registry resolve to the local host.
     port:
         required: false
             - IceGrid registry port. Defaults to 4061.
@@ -59,15 +63,47 @@ options:
         description:
             - Skip servers which are not listed in the IceGrid Registry. If set to 'no', an error will be occur if
               a specified server does not exist.
+    force:
+        required: false
+        default: "no"
+        choices: [ "yes", "no" ]
+        description:
+            - Send the enable, start, or stop requests without first querying the current state of the servers.
+              Starting an active server or stopping an inactive one is not an error. All servers are reported as
+              enabled or disabled, as the module cannot tell which were already.
     args:
         required: false
         description:
             - List of arguments to pass for Ice configuration.
+    cached_server_ids:
+        required: false
+        description:
+            - The icegrid_server_ids fact returned by an earlier task. If it holds the server ids of the same
+              registry, is younger than cache_valid_time and contains all the requested servers, the ids are not
+              fetched from the registry again. If servers is not set, servers deployed during that time are not
+              acted on.
+    cache_valid_time:
+        required: false
+        default: 30
+        description:
+            - Number of seconds for which cached_server_ids is considered valid.
 '''
 
 EXAMPLES = '''
 # Example action to start all servers, if not running
 - icegrid_servers: state=started
+
+# Reuse the server ids fetched by the previous task of the play
+- icegrid_servers:
+    enabled: yes
+    cached_server_ids: "{{ icegrid_server_ids | default({}) }}"
+
+# Run on the registry host to avoid the WAN latency of the requests sent to the registry
+- icegrid_servers:
+    state: started
+    username: admin
+    password: secret
+  delegate_to: "{{ icegrid_registry_host }}"
 '''
 
 RETURN = '''
@@ -91,19 +127,63 @@ stateChanged:
     returned: when state is not None
     type: list
     sample: ['server1', 'server2']
+ansible_facts:
+    description: The icegrid_server_ids fact, mapping a registry to its server ids and the time they were fetched.
+    returned: when the server ids were fetched from the registry
+    type: dict
+    sample: {'icegrid_server_ids': {'localhost:4061': {'ids': ['server1', 'server2'], 'cached_at': 1476525600.0}}}
 ...
 '''
 
 from ansible.module_utils.basic import *
 
+import threading
+import time
+
 import Ice, IceGrid
 from IceGrid import ServerState
 
-class IceGridModule(Ice.Application):
+# Tracks a set of outstanding asynchronous invocations. As soon as the reply of an invocation arrives its result
+# is passed to the callback given to add(), which may itself add further invocations. The exception of a failed
+# invocation is stored at index i of the errors list given to add(), and wait() blocks until all invocations,
+# including those added by callbacks, completed.
+class PendingCalls(object):
+
+    def __init__(self):
+        self.failed     = False
+        self.count      = 0
+        self.lock       = threading.Lock()
+        self.done       = threading.Event()
+        self.done.set()
+
+    def add(self, errors, i, future, callback=None):
+        with self.lock:
+            self.count += 1
+            self.done.clear()
+        future.add_done_callback(lambda f: self.completed(errors, i, f, callback))
+
+    def completed(self, errors, i, future, callback):
+        try:
+            result = future.result()
+            if callback:
+                callback(result)
+        except Exception as ex:
+            errors[i] = ex
+            self.failed = True
+
+        with self.lock:
+            self.count -= 1
+            if self.count == 0:
+                self.done.set()
 
-    def __init__(self, module):
-        Ice.Application.__init__(self)
+    def wait(self):
+        self.done.wait()
+
+class IceGridModule(object):
+
+    def __init__(self, module, communicator):
         self.module         = module
+        self.communicator   = communicator
         self.host           = module.params['host']
         self.port           = module.params['port']
         self.config         = module.params['config']
@@ -114,11 +194,16 @@ class IceGridModule(Ice.Application):
         self.password       = module.params['password']
         self.secure         = module.params['secure']
         self.skip           = module.params['skip']
-        self.serverState    = {}
+        self.force          = module.params['force']
+        self.cachedIds      = module.params['cached_server_ids']
+        self.cacheValidTime = module.params['cache_valid_time']
+        self.idsFromCache   = False
+        self.enabledChanged = bytearray()
+        self.stateChanged   = bytearray()
         self.result         = {}
 
-    def run(self, args):
-        comm = self.communicator()
+    def run(self):
+        comm = self.communicator
 
         if self.config is None:
             locatorFinderStr = "Ice/LocatorFinder:default -h {} -p {}".format(self.host, self.port)
@@ -133,24 +218,23 @@ class IceGridModule(Ice.Application):
         except Ice.LocalException as ex:
             self.module.fail_json(msg="Error connecting to IceGrid Registry. {}".format(ex))
 
-        try:
-            if self.secure:
-                session = registry.createAdminSessionFromSecureConnection()
-            else:
-                session = registry.createAdminSession(self.username, self.password)
-        except IceGrid.PermissionDeniedException:
-            self.module.fail_json(msg="Permission denied. Please verify username and password.")
-
+        session = self.createSession(registry)
         self.admin = session.getAdmin()
 
-        self.allServers = self.admin.getAllServerIds()
+        allServerIds = self.getAllServerIds()
+        self.allServers = frozenset(allServerIds)
 
+        # The servers are usually all known to the registry, which a single set operation confirms. The servers
+        # are only filtered one by one, keeping their order, if that's not the case.
         if self.servers is None:
-            self.servers = self.allServers
+            self.servers = allServerIds
+            # The servers weren't named by the user, so those removed since the ids were cached are always skipped.
+            self.skip = self.skip or self.idsFromCache
+        elif self.allServers.issuperset(self.servers):
+            pass
         elif not self.skip:
             nonExistantServers = [m for m in self.servers if m not in self.allServers]
-            if nonExistantServers:
-                self.module.fail_json(msg="The following servers do not exist: {}".format(', '.join(nonExistantServers)))
+            self.module.fail_json(msg="The following servers do not exist: {}".format(', '.join(nonExistantServers)))
         else:
             self.servers = [m for m in self.servers if m in self.allServers]
 
@@ -161,89 +245,205 @@ class IceGridModule(Ice.Application):
         if not self.servers:
             self.module.exit_json(**self.result)
 
-        responses = []
-        for server in self.servers:
-            isEnabled = self.admin.begin_isServerEnabled(server)
-            serverState = self.admin.begin_getServerState(server)
-            responses.append((server, isEnabled, serverState))
+        self.updateServers()
+        self.result['servers'] = self.servers
 
-        for response in responses:
-            # A list of tuples ("server id", "server enabled", "server state"). This is later used to determine
-            # if we really need to perform an action on a server.
-            self.serverState[response[0]] = (self.admin.end_isServerEnabled(response[1]),
-                                             self.admin.end_getServerState(response[2]))
+        self.module.exit_json(**self.reportChanges(self.result))
 
-        self.result['changed'] = False
+    # Add whether any server was changed, and the lists of changed servers, to result. The server names are only
+    # collected at the end, and not at all if no server had to be changed.
+    def reportChanges(self, result):
+        enabledChanged = 1 in self.enabledChanged
+        stateChanged = 1 in self.stateChanged
+        result['changed'] = enabledChanged or stateChanged
         if self.enabled is not None:
-            self.result['enabled' if self.enabled == True else 'disabled'] = []
-            self.enableServers()
+            result['enabled' if self.enabled == True else 'disabled'] = \
+                [s for s, c in zip(self.servers, self.enabledChanged) if c] if enabledChanged else []
 
         if self.state is not None:
-            self.result['stateChanged'] = []
-            self.updateServerState()
-
-        self.module.exit_json(**self.result)
-
-    # Enable or disable servers based on "enabled" setting.
-    def enableServers(self):
-        responses = []
-        for server in self.servers:
-            if self.serverState[server][0] != self.enabled:
-                responses.append((server, self.admin.begin_enableServer(server, self.enabled)))
-
-        for server, r in responses:
-            try:
-                self.admin.end_enableServer(r)
-                self.result['enabled' if self.enabled else 'disabled'].append(server)
-            except IceGrid.ServerNotExistException as ex:
-                self.module.fail_json(msg="Server {} does not exist".format(ex.id))
-            except IceGrid.NodeUnreachableException as ex:
-                self.module.fail_json(msg="Node {} could not be reached. {}".format(ex.name, ex.reason))
-            except IceGrid.DeploymentException as ex:
-                self.module.fail_json(msg="IceGrid.DeploymentException: {}".format(ex.reason))
-
-        # We know for sure that some sever was enabled or disabled if we have at least one response
-        if responses:
-            self.result['changed'] = True
-
-    # Update the state of servers to either be started or stopped
-    def updateServerState(self):
-        unchangedStateList = []
+            result['stateChanged'] = [s for s, c in zip(self.servers, self.stateChanged) if c] if stateChanged else []
+        return result
+
+    # Create an admin session and keep it alive for as long as the module runs. The registry destroys a session
+    # once its connection is closed, so a session cannot be shared with later tasks, which run in a new process.
+    def createSession(self, registry):
+        # Sent together with the session request so that it doesn't cost an extra round trip.
+        acmTimeout = registry.getACMTimeoutAsync()
+
+        try:
+            if self.secure:
+                session = registry.createAdminSessionFromSecureConnection()
+            else:
+                session = registry.createAdminSession(self.username, self.password)
+        except IceGrid.PermissionDeniedException:
+            self.module.fail_json(msg="Permission denied. Please verify username and password.")
+
+        # Let Ice heartbeat the connection so that the registry doesn't reap the session, and close the
+        # connection, while a long running start or stop is still in progress.
+        session.ice_getConnection().setACM(acmTimeout.result(), Ice.Unset, Ice.ACMHeartbeat.HeartbeatAlways)
+        return session
+
+    # Return the ids of all servers of the registry. The ids cached by an earlier task are used if they are recent
+    # enough, otherwise they're fetched from the registry and returned to Ansible as the icegrid_server_ids fact.
+    def getAllServerIds(self):
+        key = self.config or "{}:{}".format(self.host, self.port)
+        cache = dict(self.cachedIds or {})
+
+        # A malformed entry is treated like a missing one. Cached ids which lack a requested server are stale.
+        try:
+            entry = cache[key]
+            if time.time() - float(entry['cached_at']) < self.cacheValidTime:
+                ids = sorted(entry['ids'])
+                if self.servers is None or frozenset(ids).issuperset(self.servers):
+                    self.idsFromCache = True
+                    return ids
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        ids = sorted(self.admin.getAllServerIds())
+        cache[key] = {'ids': ids, 'cached_at': time.time()}
+        self.result['ansible_facts'] = {'icegrid_server_ids': cache}
+        return ids
+
+    # Fail with a message describing an exception raised by an IceGrid Admin operation. The requests for the other
+    # servers are not held back by a failure, so the servers which were changed nonetheless are reported as well.
+    def failOnException(self, ex):
+        if isinstance(ex, IceGrid.ServerNotExistException):
+            msg = "Server {} does not exist".format(ex.id)
+        elif isinstance(ex, IceGrid.ServerStartException):
+            msg = "Failed to start server {}. {}".format(ex.id, ex.reason)
+        elif isinstance(ex, IceGrid.ServerStopException):
+            msg = "Failed to stop server {}. {}".format(ex.id, ex.reason)
+        elif isinstance(ex, IceGrid.NodeUnreachableException):
+            msg = "Node {} could not be reached. {}".format(ex.name, ex.reason)
+        elif isinstance(ex, IceGrid.DeploymentException):
+            msg = "IceGrid.DeploymentException: {}".format(ex.reason)
+        elif isinstance(ex, Ice.Exception):
+            msg = "Unexpected Ice exception: {}".format(ex)
+        else:
+            raise ex
+        self.module.fail_json(msg=msg, **self.reportChanges({}))
+
+    # Apply the "enabled" and "state" settings to all servers. IceGrid has no bulk operations, so each server is
+    # queried and updated with its own requests. All probes are dispatched up front, and the action for a server
+    # is dispatched from the callback of its probe as soon as the probe returns, while the probes of the other
+    # servers are still in flight. Only the attributes needed by the task are probed.
+    def updateServers(self):
         if self.state == 'started':
-            unchangedStateList.extend([ServerState.Active, ServerState.Activating])
-            beginCall = lambda s: self.admin.begin_startServer(s)
-            endCall =  lambda r: self.admin.end_startServer(r)
+            self.unchangedStateList = [ServerState.Active, ServerState.Activating]
+            self.stateCall = self.admin.startServerAsync
         elif self.state == 'stopped':
-            unchangedStateList.extend([ServerState.Inactive, ServerState.Deactivating, ServerState.Destroying])
-            beginCall = lambda s: self.admin.begin_stopServer(s)
-            endCall =  lambda r: self.admin.end_stopServer(r)
-        else:
+            self.unchangedStateList = [ServerState.Inactive, ServerState.Deactivating, ServerState.Destroying]
+            self.stateCall = self.admin.stopServerAsync
+        elif self.state is not None:
             # It should be impossible to get this far.
             self.module.fail_json(msg="Unknown state {}.".format(self.state))
 
-        responses = []
-        for server in self.servers:
-            if self.serverState[server][1] not in unchangedStateList:
-                responses.append((server, beginCall(server)))
-
-        for server, r in responses:
-            try:
-                endCall(r)
-                self.result['stateChanged'].append(server)
-            except IceGrid.ServerNotExistException as ex:
-                self.module.fail_json(msg="Server {} does not exist".format(ex.id))
-            except IceGrid.ServerStartException as ex:
-                self.module.fail_json(msg="Failed to start server {}. {}".format(ex.id, ex.reason))
-            except IceGrid.ServerStopException as ex:
-                self.module.fail_json(msg="Failed to stop server {}. {}".format(ex.id, ex.reason))
-            except IceGrid.NodeUnreachableException as ex:
-                self.module.fail_json(msg="Node {} could not be reached. {}".format(ex.name, ex.reason))
-            except IceGrid.DeploymentException as ex:
-                self.module.fail_json(msg="IceGrid.DeploymentException: {}".format(ex.reason))
-
-        # We know for sure that some state was changed if we have at least one response
-        if responses:
-            self.result['changed'] = True
+        # IceGrid refuses to start a disabled server, so a server is only started once it has been enabled. Stopping
+        # a server doesn't depend on whether it's enabled, so stop requests are sent along with the enable requests.
+        startAfterEnable = self.enabled is not None and self.state == 'started'
+
+        # One flag per server, in the order of self.servers, set once the server was enabled or disabled, or its
+        # state was changed. Each callback only assigns the flag of its own server, so no locking is needed.
+        n = len(self.servers)
+        self.enabledChanged = bytearray(n)
+        self.stateChanged = bytearray(n)
+
+        # The exceptions raised by each kind of request, in the order of self.servers.
+        self.isEnabledErrors = [None] * n
+        self.enableErrors = [None] * n
+        self.getStateErrors = [None] * n
+        self.setStateErrors = [None] * n
+
+        self.pending = PendingCalls()
+        for i, server in enumerate(self.servers):
+            serverState = None
+            if self.state is not None and not self.force:
+                serverState = self.admin.getServerStateAsync(server)
+
+            if startAfterEnable:
+                self.checkEnabled(i, lambda i=i, f=serverState: self.checkServerState(i, f))
+            else:
+                if self.enabled is not None:
+                    self.checkEnabled(i, None)
+                if self.state is not None:
+                    self.checkServerState(i, serverState)
+        self.pending.wait()
+
+        if not self.pending.failed:
+            return
+
+        # With "skip" set, servers removed from the registry since the server ids were fetched are skipped.
+        skipped = set()
+        errors = zip(self.isEnabledErrors, self.enableErrors, self.getStateErrors, self.setStateErrors)
+        for i, serverErrors in enumerate(errors):
+            for ex in serverErrors:
+                if ex is None or (self.force and self.isStateUnchanged(ex)):
+                    continue
+                if self.skip and isinstance(ex, IceGrid.ServerNotExistException):
+                    skipped.add(i)
+                else:
+                    self.failOnException(ex)
+
+        if skipped:
+            kept = [i for i in range(n) if i not in skipped]
+            self.servers = [self.servers[i] for i in kept]
+            self.enabledChanged = bytearray(self.enabledChanged[i] for i in kept)
+            self.stateChanged = bytearray(self.stateChanged[i] for i in kept)
+
+    # With "force" set, starting an active server or stopping an inactive one is not an error. The reasons are those
+    # given by the IceGrid node when it rejects the request (ServerI::start and ServerI::stop in
+    # cpp/src/IceGrid/ServerI.cpp).
+    def isStateUnchanged(self, ex):
+        if self.state == 'started':
+            return isinstance(ex, IceGrid.ServerStartException) and ex.reason == "The server is already active."
+        else:
+            return isinstance(ex, IceGrid.ServerStopException) and ex.reason == "The server is already inactive."
+
+    # Query whether the i-th server is enabled, unless forced, and then apply the "enabled" setting. Once the server
+    # is enabled or disabled, then is called if set.
+    def checkEnabled(self, i, then):
+        if self.force:
+            self.enableServer(i, None, then)
+        else:
+            self.pending.add(self.isEnabledErrors, i, self.admin.isServerEnabledAsync(self.servers[i]),
+                             lambda enabled: self.enableServer(i, enabled, then))
+
+    # Enable or disable the i-th server based on "enabled" setting. In check mode, the server is only reported.
+    def enableServer(self, i, enabled, then):
+        if not self.force and enabled == self.enabled:
+            if then:
+                then()
+        elif self.module.check_mode:
+            self.serverEnabled(i, then)
+        else:
+            self.pending.add(self.enableErrors, i, self.admin.enableServerAsync(self.servers[i], self.enabled),
+                             lambda r: self.serverEnabled(i, then))
+
+    def serverEnabled(self, i, then):
+        self.enabledChanged[i] = 1
+        if then:
+            then()
+
+    # Wait for the state of the i-th server, unless forced, and then apply the "state" setting.
+    def checkServerState(self, i, serverState):
+        if self.force:
+            self.updateServerState(i, None)
+        else:
+            self.pending.add(self.getStateErrors, i, serverState, lambda state: self.updateServerState(i, state))
+
+    # Update the state of the i-th server to either be started or stopped. In check mode, the server is only reported.
+    def updateServerState(self, i, state):
+        if not self.force and state in self.unchangedStateList:
+            return
+        if self.module.check_mode:
+            self.serverStateChanged(i)
+        else:
+            self.pending.add(self.setStateErrors, i, self.stateCall(self.servers[i]),
+                             lambda r: self.serverStateChanged(i))
+
+    def serverStateChanged(self, i):
+        self.stateChanged[i] = 1
 
 def main():
     argument_spec = dict(
@@ -257,10 +457,13 @@ def main():
         password=dict(required=False, default=None, type='str'),
         secure=dict(required=False, default='no', type='bool'),
         skip=dict(required=False, default='no', type='bool'),
-        args=dict(required=False, default=[], type='list')
+        force=dict(required=False, default='no', type='bool'),
+        args=dict(required=False, default=[], type='list'),
+        cached_server_ids=dict(required=False, default=None, type='dict'),
+        cache_valid_time=dict(required=False, default=30, type='int')
     )
 
-    module = AnsibleModule(argument_spec = argument_spec)
+    module = AnsibleModule(argument_spec = argument_spec, supports_check_mode = True)
 
     if module.params['state'] == None and module.params['enabled'] == None:
         module.fail_json(msg="One of 'state' or 'enabled' must be set.")
@@ -272,8 +475,24 @@ def main():
     args = ['Ansible IceGrid Server Module']
     args.extend(module.params['args'])
 
-    app = IceGridModule(module)
-    app.main(args, module.params['config'])
+    # The client thread pool dispatches the completion callbacks of the admin requests. Let it process the replies
+    # of several servers concurrently, and never close idle connections so that the connection to the registry
+    # doesn't have to be re-established mid-run. The config file and args can still override these settings.
+    servers = module.params['servers']
+    initData = Ice.InitializationData()
+    initData.properties = Ice.createProperties()
+    initData.properties.setProperty('Ice.ThreadPool.Client.Size', str(min(16, len(servers))) if servers else '16')
+    initData.properties.setProperty('Ice.ThreadPool.Client.SizeMax', '64')
+    initData.properties.setProperty('Ice.ACM.Client.Close', '0')
+    if module.params['config'] is not None:
+        initData.properties.load(module.params['config'])
+
+    # The module is a short lived client, so there's no need for the signal handling of Ice.Application.
+    communicator = Ice.initialize(args, initData)
+    try:
+        IceGridModule(module, communicator).run()
+    finally:
+        communicator.destroy()
 
 if __name__ == '__main__':
     main()